@@ -1,5 +1,8 @@
 import argparse
+import logging
+from pathlib import Path
 
+import ahocorasick
 from dotenv import load_dotenv
 
 from html_extractor import html_explorer
@@ -7,6 +10,10 @@ from llmstatemachine import WorkflowAgentBuilder, set_next_state
 
 load_dotenv()
 
+# Show agent steps, library logs them at DEBUG level
+logging.basicConfig(format="%(message)s")
+logging.getLogger("llmstatemachine").setLevel(logging.DEBUG)
+
 
 # [INIT] => [FOCUS or SELECT]
 # [SELECTED_NON_EMPTY] => [FOCUS or SELECT or VALIDATE]
@@ -33,6 +40,12 @@ def validate(argument: str):
     if not output:
         set_next_state("SELECTED_NON_EMPTY")
         return f"validate '{argument}' did not return any elements."
+    # Scan the output once for all expectations
+    found = (
+        {expectation for _, expectation in expectations_automaton.iter(output)}
+        if expectations
+        else set()
+    )
     for expectation in expectations:
         if expectation in argument:
             set_next_state("SELECTED_NON_EMPTY")
@@ -40,7 +53,7 @@ def validate(argument: str):
                 f"""validate "{argument}" failed: css selector contains text "{expectation}". """
                 + "Do not use the expected text in the selector."
             )
-        if expectation not in output:
+        if expectation not in found:
             set_next_state("SELECTED_NON_EMPTY")
             return (
                 f"""validate "{argument}" did not contain element with "{expectation}".""",
@@ -73,8 +86,7 @@ if __name__ == "__main__":
     file_path = args.file_path
 
     # Read the HTML file
-    with open(file_path) as f:
-        html_content = f.read()
+    html_content = Path(file_path).read_text(encoding="utf-8", errors="replace")
 
     print("--- Give few examples that should be discovered with correct selector ---")
     examples: list[str] = []
@@ -89,6 +101,10 @@ if __name__ == "__main__":
 
     examples_str = '"' + '", "'.join(examples) + '"'
     expectations = examples
+    expectations_automaton = ahocorasick.Automaton()
+    for expectation in expectations:
+        expectations_automaton.add_word(expectation, expectation)
+    expectations_automaton.make_automaton()
     builder = WorkflowAgentBuilder()
     builder.add_system_message(
         (
@@ -1,33 +1,43 @@
 import argparse
+import functools
 import math
 import re
-from typing import Iterable, List, Optional, Set, cast
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple, Union
 
 from bs4 import BeautifulSoup, Comment, NavigableString, PageElement, Tag
+from selectolax.lexbor import LexborHTMLParser, SelectolaxError
 
 
+# Matches HTML comments and the doctype declaration in a single pass
+COMMENT_AND_DOCTYPE_PATTERN = re.compile(
+    r"<!--.*?-->|<!DOCTYPE.*?>", flags=re.DOTALL | re.IGNORECASE
+)
+
+
+# Matches the opening tag of a full document's html root element
+HTML_ROOT_PATTERN = re.compile(r"<html[\s>]", flags=re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4)
 def remove_html_comments_and_doctype(html_string: str) -> str:
     """
     Removes HTML comments and the doctype declaration from a string containing HTML.
     """
-    comment_pattern = (
-        r"<!--(.*?)-->"  # Regular expression pattern to match HTML comments
-    )
-    doctype_pattern = r"<!DOCTYPE.*?>"  # Regular expression pattern to match doctype
-
-    # Remove comments
-    html_string = re.sub(comment_pattern, "", html_string, flags=re.DOTALL)
+    return COMMENT_AND_DOCTYPE_PATTERN.sub("", html_string)
 
-    # Remove doctype
-    html_string = re.sub(doctype_pattern, "", html_string, flags=re.IGNORECASE)
-
-    return html_string
 
+@functools.lru_cache(maxsize=4)
+def parse_html(html: str) -> LexborHTMLParser:
+    """
+    Parses HTML with Lexbor and caches the tree for repeated CSS selector queries.
+    The returned tree is shared between callers and must not be modified.
+    """
+    return LexborHTMLParser(html)
 
-def collapse_html_elements(html: str, collapsed_elements: List[str]) -> BeautifulSoup:
-    html = remove_html_comments_and_doctype(html)
-    soup = BeautifulSoup(html, "html.parser")
 
+def collapse_elements(soup: BeautifulSoup, collapsed_elements: List[str]) -> None:
+    """Replace the content of matching elements with a comment describing it."""
     for name in collapsed_elements:
         for elem in soup.select(name):
             comment_parts = []
@@ -36,7 +46,7 @@ def collapse_html_elements(html: str, collapsed_elements: List[str]) -> Beautifu
             attr_count = len(elem.attrs)
             if attr_count:
                 comment_parts.append(f"{attr_count} attrs")
-                elem.attrs = {}  # Clearing all attributes at once
+                elem.attrs.clear()  # Clearing all attributes at once
 
             # Check for direct textual content
             if elem.string:
@@ -45,7 +55,7 @@ def collapse_html_elements(html: str, collapsed_elements: List[str]) -> Beautifu
                 comment_parts.append(f"{char_count} chars, {line_count} lines")
 
             # Check for child elements
-            child_count = len(list(elem.children))
+            child_count = len(elem.contents)
             if child_count:
                 comment_parts.append(f"{child_count} elems")
 
@@ -55,9 +65,31 @@ def collapse_html_elements(html: str, collapsed_elements: List[str]) -> Beautifu
             elem.clear()
             elem.append(comment)  # append the comment to the cleared element
 
+
+def collapse_html_elements(html: str, collapsed_elements: List[str]) -> BeautifulSoup:
+    html = remove_html_comments_and_doctype(html)
+    # lxml wraps fragments, like joined CSS selector matches, in made-up
+    # html and body elements, so fragments are parsed as they are
+    parser = "lxml" if HTML_ROOT_PATTERN.search(html) else "html.parser"
+    soup = BeautifulSoup(html, parser)
+    if collapsed_elements:
+        collapse_elements(soup, collapsed_elements)
     return soup
 
 
+@functools.lru_cache(maxsize=4)
+def collapsed_soup(html: str, collapsed_elements: Tuple[str, ...]) -> BeautifulSoup:
+    """
+    Cached collapse_html_elements for repeated calls on the same document.
+    The returned soup is shared between callers and must not be modified.
+    """
+    return collapse_html_elements(html, list(collapsed_elements))
+
+
+# Typical breakpoints for shortening strings
+BREAKPOINTS = (" ", "/", ".", ",", ";", "-", "_")
+
+
 def pluralize(count: int) -> str:
     """Return 'item' or 'items' based on the count."""
     return "item" if count == 1 else "items"
@@ -74,10 +106,11 @@ def shortened_string(
         return content
 
     # If focus is present and fits within the length constraint
-    if focus_text and focus_text in content:
-        start_idx = max(content.find(focus_text) - context_length, 0)
+    focus_idx = content.find(focus_text) if focus_text else -1
+    if focus_idx != -1:
+        start_idx = max(focus_idx - context_length, 0)
         end_idx = min(
-            content.find(focus_text) + len(focus_text) + context_length,
+            focus_idx + len(focus_text) + context_length,
             len(content),
         )
 
@@ -93,52 +126,72 @@ def shortened_string(
 
         return f"{ellipsis_prefix}{truncated_str}{ellipsis_suffix}"
 
-    # No focus, just general shortening
-    breakpoints = [" ", "/", ".", ",", ";", "-", "_"]  # typical breakpoints
     # No focus, just general shortening
     mid_idx = len(content) // 2
-    left_break = mid_idx
-    right_break = mid_idx
 
     # Search left from the midpoint for a natural breakpoint
-    while left_break > 0 and content[left_break] not in breakpoints:
-        left_break -= 1
+    left_break = max(max(content.rfind(bp, 0, mid_idx + 1) for bp in BREAKPOINTS), 0)
 
     # Search right from the midpoint for a natural breakpoint
-    while right_break < len(content) and content[right_break] not in breakpoints:
-        right_break += 1
+    right_break = min(
+        (idx for idx in (content.find(bp, mid_idx) for bp in BREAKPOINTS) if idx != -1),
+        default=len(content),
+    )
 
     begin_part = content[:left_break]
     end_part = content[right_break:]
 
     # If the total length exceeds max_string_length, adjust the lengths
-    while len(begin_part) + len(end_part) + 2 > max_string_length:  # plus 2 for ".."
-        # If one part is longer, trim it first. Otherwise, trim both.
-        if len(begin_part) > len(end_part):
-            begin_part = begin_part[:-1]
-        elif len(end_part) > len(begin_part):
-            end_part = end_part[1:]
+    available = max_string_length - 2  # minus 2 for ".."
+    excess = len(begin_part) + len(end_part) - available
+    if excess > 0:
+        # Trim the longer part first. Once both are equally long, trim both.
+        begin_len, end_len = len(begin_part), len(end_part)
+        if excess <= abs(begin_len - end_len):
+            if begin_len > end_len:
+                begin_len -= excess
+            else:
+                end_len -= excess
         else:
-            begin_part = begin_part[:-1]
-            end_part = end_part[1:]
+            begin_len = end_len = available // 2
+        begin_part = begin_part[:begin_len]
+        end_part = end_part[len(end_part) - end_len :]
 
     return f"{begin_part}..{end_part}"
 
 
+def attribute_value(value: Union[str, List[str]]) -> str:
+    """Return attribute value as a string, joining multi-valued attributes."""
+    return value if isinstance(value, str) else " ".join(value)
+
+
 def attributes_with_focus_text(tag: Tag, focus_text: str) -> List[str]:
     """Return attributes that contain the focus target text."""
     if not focus_text:
         return []
-    return [attr for attr, value in tag.attrs.items() if focus_text in str(value)]
+    return [
+        attr
+        for attr, value in tag.attrs.items()
+        if focus_text in attribute_value(value)
+    ]
 
 
 def children_with_focus_text(
-    children: Iterable[PageElement], focus_text: str
+    children: Iterable[PageElement],
+    focus_text: str,
+    rendered: Optional[List[str]] = None,
 ) -> List[int]:
     """Return child element indecies that contain the focus target text."""
     if not focus_text:
         return []
-    return [index for index, child in enumerate(children) if focus_text in str(child)]
+    if rendered is not None:
+        return [index for index, text in enumerate(rendered) if focus_text in text]
+    # Strings are searched as is, tags need str format to include their attributes
+    return [
+        index
+        for index, child in enumerate(children)
+        if focus_text in (child if isinstance(child, NavigableString) else str(child))
+    ]
 
 
 def format_content(
@@ -151,54 +204,41 @@ def format_content(
     )
 
 
+def order_attributes(
+    tag: Tag, attribute_priority: List[str], focus_text: str
+) -> List[Tuple[str, str]]:
+    """Return attribute name and value pairs ordered by focus, priority and name."""
+    ordered = dict.fromkeys(attributes_with_focus_text(tag, focus_text))
+    ordered.update(
+        dict.fromkeys(attr for attr in attribute_priority if attr in tag.attrs)
+    )
+    ordered.update(dict.fromkeys(sorted(tag.attrs)))
+    return [(attr, attribute_value(tag.attrs[attr])) for attr in ordered]
+
+
 def format_attributes(
     tag: Tag,
     attribute_priority: List[str],
     focus_text: str,
     max_size_for_attrs: int,
 ) -> List[str]:
-    # Initialize
+    # Render all candidate attributes in one pass
+    attr_strs = [
+        f' {attr}="{shortened_string(value, focus_text)}"'
+        for attr, value in order_attributes(tag, attribute_priority, focus_text)
+    ]
+
+    # Show the attributes that fit in order of preference
     attrs_to_show: List[str] = []
     current_size = 0
-    hidden_attr_count = 0
-
-    # Function to try adding an attribute and update current_size
-    def try_add_attribute(attr: str, val: str) -> bool:
-        nonlocal current_size
-        if isinstance(val, list):
-            val = " ".join(val)
-        val = shortened_string(val, focus_text)
-        attr_str = f' {attr}="{val}"'
+    for attr_str in attr_strs:
         new_size = current_size + len(attr_str)
         if new_size <= max_size_for_attrs:
             attrs_to_show.append(attr_str)
             current_size = new_size
-            return True
-        return False
-
-    all_attrs: Set[str] = set(tag.attrs.keys())
-
-    # Add focused attributes
-    focused_attrs = attributes_with_focus_text(tag, focus_text)
-    for attr in focused_attrs:
-        if attr in all_attrs:
-            if not try_add_attribute(attr, cast(str, tag[attr])):
-                hidden_attr_count += 1
-            all_attrs.remove(attr)
-
-    # Add priority attributes
-    for attr in attribute_priority:
-        if attr in all_attrs:
-            if not try_add_attribute(attr, cast(str, tag[attr])):
-                hidden_attr_count += 1
-            all_attrs.remove(attr)
-
-    # Add other attributes
-    for attr in sorted(all_attrs):
-        if not try_add_attribute(attr, cast(str, tag[attr])):
-            hidden_attr_count += 1
 
     # Add hidden attribute count if necessary
+    hidden_attr_count = len(attr_strs) - len(attrs_to_show)
     if hidden_attr_count > 0:
         attrs_to_show.append(f" .. (+{hidden_attr_count} attrs)")
 
@@ -212,11 +252,14 @@ def format_children(
     attribute_priority: List[str],
     max_size_for_children: int,
     max_child_elements: int = 5,
+    rendered: Optional[List[str]] = None,
 ) -> List[str]:
-    """Handle the children of a tag."""
+    """Handle the children of a tag, reusing their str forms from `rendered` if given."""
+    if rendered is None:
+        rendered = [str(child) for child in children]
 
     # Get focused children
-    focused_children = children_with_focus_text(children, focus_text)[
+    focused_children = children_with_focus_text(children, focus_text, rendered)[
         :max_child_elements
     ]
 
@@ -224,30 +267,24 @@ def format_children(
     slots_for_others = max_child_elements - len(focused_children)
 
     # Collect the children to be displayed, giving priority to focused children
-    children_to_display = sorted(
-        set(
-            focused_children
-            + [
-                index
-                for index, child in enumerate(children)
-                if child not in focused_children
-            ][:slots_for_others]
-        )
-    )
+    focused_set = set(focused_children)
+    other_children = [
+        index for index in range(len(children)) if index not in focused_set
+    ][:slots_for_others]
+    children_to_display = sorted(focused_set.union(other_children))
 
     running_index = 0  # This tracks where we are in the original list of all children
-    all_children_list = list(children)
 
     size_of_displayed_children = sum(
-        len(str(all_children_list[child_index])) for child_index in children_to_display
+        len(rendered[child_index]) for child_index in children_to_display
     )
 
     result: List[str] = []
     for child_index in children_to_display:
         # Get the original index of the child
-        child = all_children_list[child_index]
+        child = children[child_index]
 
-        child_total_size = len(str(child))
+        child_total_size = len(rendered[child_index])
         allocated_size = int(
             max_size_for_children * child_total_size / size_of_displayed_children
         )
@@ -268,6 +305,7 @@ def format_children(
                 focus_text,
                 attribute_priority,
                 allocated_size,
+                prerendered=rendered[child_index],
             )
         )
 
@@ -275,7 +313,7 @@ def format_children(
         running_index = child_index + 1
 
     # Add a placeholder for any remaining hidden children
-    hidden_count = len(all_children_list) - running_index
+    hidden_count = len(children) - running_index
     if hidden_count > 0:
         hidden_word = "items" if hidden_count > 1 else "item"
         result.append(f"<!-- .. skipped {hidden_count} {hidden_word} .. -->")
@@ -289,6 +327,7 @@ def format_element(
     focus_text: str,
     attribute_priority: List[str],
     max_element_size: int,
+    prerendered: Optional[str] = None,
 ) -> str:
     if isinstance(tag, NavigableString):
         return format_content(tag, focus_text, max_element_size)
@@ -296,19 +335,18 @@ def format_element(
     if not isinstance(tag, Tag):
         return separator + f"unknown {tag}"
 
-    pretty_tag = str(tag)
+    pretty_tag = str(tag) if prerendered is None else prerendered
     if max_element_size >= len(pretty_tag):
         return separator + pretty_tag
 
     # Calculate size of attributes in pretty format
     attrs_size = sum(len(f' {attr}="{value}"') for attr, value in tag.attrs.items())
 
-    # Calculate size of children in str format
-    children_size = sum(
-        len(str(child))
-        for child in tag.children
-        if isinstance(child, (Tag, NavigableString))
-    )
+    # Calculate size of children in str format. Children of a tag are always
+    # tags or strings, so its contents list is used as is without filtering.
+    children_list = tag.contents
+    rendered_children = [str(child) for child in children_list]
+    children_size = sum(map(len, rendered_children))
 
     attrs_and_children_size = attrs_size + children_size
 
@@ -339,11 +377,12 @@ def format_element(
 
     children = "".join(
         format_children(
-            list(tag.children),
+            children_list,
             separator,
             focus_text,
             attribute_priority,
             max_size_for_children,
+            rendered=rendered_children,
         )
     )
 
@@ -362,18 +401,22 @@ def truncate_until(original_html: str, focus_text: str, max_total_length: int) -
     if len(original_html) <= max_total_length:
         return original_html
 
-    # Find all occurrences of focus_text
-    matches = focus_text and list(re.finditer(focus_text, original_html))
-    if not matches or not focus_text:
+    # Find all occurrences of focus_text and calculate the segments to preserve
+    preserved_segments = []
+    if focus_text:
+        start = original_html.find(focus_text)
+        while start != -1:
+            end = start + len(focus_text)
+            preserved_segments.append((start, end))
+            start = original_html.find(focus_text, end)
+
+    if not preserved_segments:
         # If no matches, return the truncated string with an omission message
         return (
             original_html[:max_total_length]
             + f" .. {len(original_html) - max_total_length} characters omitted"
         )
 
-    # Calculate the segments to preserve
-    preserved_segments = [(m.start(), m.end()) for m in matches]
-
     # Sort and merge overlapping segments
     preserved_segments.sort()
     merged_segments = []
@@ -410,7 +453,8 @@ def truncate_until(original_html: str, focus_text: str, max_total_length: int) -
     )  # Add the final segment after the last focus_text
 
     # Build the truncated HTML with preserved segments and distribute remaining space
-    truncated_html = ""
+    parts: List[str] = []
+    total_length = 0
     for i in range(len(truncated_segments)):
         # Calculate the length to be allocated to this segment
         segment_length = remaining_length // max(1, (len(truncated_segments) - i))
@@ -418,25 +462,29 @@ def truncate_until(original_html: str, focus_text: str, max_total_length: int) -
         # If the calculated segment length is 0 and there is remaining length, allocate 1 character
         segment_length = max(1, segment_length) if remaining_length > 0 else 0
 
-        truncated_html += truncated_segments[i][:segment_length]
-        remaining_length -= len(truncated_segments[i][:segment_length])
+        segment = truncated_segments[i][:segment_length]
+        parts.append(segment)
+        total_length += len(segment)
+        remaining_length -= len(segment)
         if remaining_length <= 0:
             break
 
     # Concatenate preserved segments with truncated segments
     last_end = 0
     for start, end in merged_segments:
-        truncated_html += original_html[last_end:start]
-        truncated_html += original_html[start:end]
+        parts.append(original_html[last_end:end])
+        total_length += end - last_end
         last_end = end
-    truncated_html += original_html[last_end : max_total_length - len(truncated_html)]
+    tail = original_html[last_end : max_total_length - total_length]
+    parts.append(tail)
+    total_length += len(tail)
 
     # Indicate if characters are omitted
-    omitted_len = len(original_html) - len(truncated_html)
+    omitted_len = len(original_html) - total_length
     if omitted_len > 0:
-        truncated_html += f" .. {omitted_len} characters omitted"
+        parts.append(f" .. {omitted_len} characters omitted")
 
-    return truncated_html
+    return "".join(parts)
 
 
 def pretty_print_html(
@@ -450,7 +498,12 @@ def pretty_print_html(
     if len(html_content) <= max_total_length:
         return html_content
 
-    soup = collapse_html_elements(html_content, collapsed_elements or [])
+    # Comments and doctype are dropped from the output anyway
+    stripped_html = remove_html_comments_and_doctype(html_content)
+    if len(stripped_html) <= max_total_length:
+        return stripped_html
+
+    soup = collapsed_soup(html_content, tuple(collapsed_elements or []))
 
     html_after_collapsed_elements = soup.prettify()
     if len(html_after_collapsed_elements) <= max_total_length:
@@ -480,9 +533,16 @@ def html_explorer(
     post_fix = ""
     # Filter by CSS selector if provided
     if css_selector:
-        soup = BeautifulSoup(html_content, "html.parser")
-        filtered_elements = soup.select(css_selector)
-        html_content = "\n".join(str(elem) for elem in filtered_elements[:max_matches])
+        try:
+            filtered_elements = parse_html(html_content).css(css_selector)
+            matches = [elem.html for elem in filtered_elements[:max_matches]]
+        except SelectolaxError:
+            # Lexbor only parses standard CSS, soupsieve also supports
+            # extensions such as :-soup-contains() and :contains()
+            soup = BeautifulSoup(html_content, "html.parser")
+            filtered_elements = soup.select(css_selector)
+            matches = [str(elem) for elem in filtered_elements[:max_matches]]
+        html_content = "\n".join(matches)
         if len(filtered_elements) > max_matches:
             post_fix = f"\n .. {len(filtered_elements) - max_matches} additional matching elements"
 
@@ -498,7 +558,8 @@ def html_explorer(
     )
 
 
-if __name__ == "__main__":
+def main(argv: Optional[List[str]] = None) -> None:
+    """Pretty print an HTML file according to the command line arguments."""
     # Initialize argparse with ArgumentDefaultsHelpFormatter
     argparser = argparse.ArgumentParser(
         description="Pretty Print HTML from file.",
@@ -535,15 +596,14 @@ if __name__ == "__main__":
     )
 
     # Parse arguments
-    args = argparser.parse_args()
+    args = argparser.parse_args(argv)
 
     # Extract individual arguments
     file_path = args.file_path
     collapsed_elements = args.collapsed_elements.split(",")
 
     # Read the HTML file
-    with open(file_path) as f:
-        html_content = f.read()
+    html_content = Path(file_path).read_text(encoding="utf-8", errors="replace")
 
     # Pretty print HTML
     print(
@@ -556,3 +616,7 @@ if __name__ == "__main__":
             max_total_length=4000 * 4,
         )
     )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,31 @@
-import subprocess
+import io
+from contextlib import redirect_stderr, redirect_stdout
 from typing import Optional, Tuple
 
 import pytest
+from bs4 import BeautifulSoup
+
+from html_extractor import format_children, html_explorer, main, truncate_until
 
 # Path to the test HTML file
 HTML_FILE_PATH = "../../test.html"
 
 
-# Helper function to run the CLI tool and capture output
+# Helper function to run the CLI tool in-process and capture output
 def run_html_extractor(args: list) -> Tuple[Optional[str], Optional[str]]:
-    command = ["python", "html_extractor.py", *args]
+    stdout, stderr = io.StringIO(), io.StringIO()
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        return (
-            result.stdout,
-            None,
-        )  # Return stdout and None for stderr to indicate no error
-    except subprocess.CalledProcessError as e:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            main(args)
+    except (Exception, SystemExit) as e:
         return (
             None,
-            e.stderr,
+            stderr.getvalue() + f"{type(e).__name__}: {e}",
         )  # Return None for stdout and stderr to indicate an error occurred
+    return (
+        stdout.getvalue(),
+        None,
+    )  # Return stdout and None for stderr to indicate no error
 
 
 # Test for invalid HTML file
@@ -78,3 +83,41 @@ def test_css_selector(css_selector, expected_element):
         assert (
             "container" in stdout
         )  # Assumes 'container' appears by default when no matching elements
+
+
+# Focus text is matched literally, not as a regular expression
+def test_truncate_until_literal_focus():
+    html = "<p>Filler text.</p>" * 50 + "<p>Price (USD): 10</p>" * 2
+    output = truncate_until(html, "(USD)", 200)
+    assert "(USD)" in output
+
+
+# Unfocused children fill the slots left over by focused ones
+def test_format_children_fills_remaining_slots():
+    soup = BeautifulSoup("".join(f"<p>item {i}</p>" for i in range(10)), "lxml")
+    result = format_children(
+        soup.body.contents, "", "item 0", [], 1000, max_child_elements=3
+    )
+    assert result[:3] == ["<p>item 0</p>", "<p>item 1</p>", "<p>item 2</p>"]
+    assert result[3] == "<!-- .. skipped 7 items .. -->"
+
+
+# Large CSS selector results are formatted without made-up ancestors
+def test_large_css_selector_result_has_no_html_root():
+    html = "<html><body>" + '<div class="row">row text</div>' * 80 + "</body></html>"
+    output = html_explorer(html, css_selector="div.row", max_total_length=200)
+    assert output.lstrip().startswith("<div")
+    assert "<html>" not in output and "<body>" not in output
+
+
+# Selectors Lexbor cannot parse are run with soupsieve instead
+@pytest.mark.parametrize(
+    "css_selector",
+    ['p:-soup-contains("Unique text")', 'p:contains("Unique text")'],
+)
+def test_css_selector_text_extensions(css_selector):
+    stdout, stderr = run_html_extractor(
+        [HTML_FILE_PATH, "--css_selector", css_selector]
+    )
+    assert stderr is None
+    assert "<p>Unique text here.</p>" in stdout
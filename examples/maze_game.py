@@ -1,88 +1,133 @@
+import logging
 from itertools import combinations
 from typing import Callable
 
+import numpy as np
 from mazelib import Maze
 from mazelib.generate.Prims import Prims
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Show agent steps, library logs them at DEBUG level
+logging.basicConfig(format="%(message)s")
+logging.getLogger("llmstatemachine").setLevel(logging.DEBUG)
+
 from llmstatemachine import WorkflowAgentBuilder, set_next_state
 
+# Print step by step diagnostics of player movement
+DEBUG = False
+
+# Direction ids index DELTAS and NAMES, bit 1 << id of MazePlayer.open_mask
+# tells whether the neighbouring cell in that direction is open
+UP, DOWN, LEFT, RIGHT = 0, 1, 2, 3
+DELTAS = ((-1, 0), (1, 0), (0, -1), (0, 1))
+NAMES = ("UP", "DOWN", "LEFT", "RIGHT")
+NAME_TO_ID = {name: d for d, name in enumerate(NAMES)}
+# State name for every open_mask value, free directions sorted by name
+MASK_TO_STATE = [
+    ":".join(sorted(name for d, name in enumerate(NAMES) if mask >> d & 1))
+    for mask in range(1 << len(NAMES))
+]
+
 
 class MazePlayer:
     def __init__(self, maze, start):
         """Initialize the maze player with the given maze and start position."""
         self.maze = maze
+        # Maze layout is fixed once generated, precompute open directions per cell
+        self.grid = np.asarray(maze.grid, dtype=np.uint8)
+        self.height, self.width = self.grid.shape
+        free = self.grid == 0
+        self.open_mask = np.zeros(self.grid.shape, dtype=np.uint8)
+        self.open_mask[1:, :] |= free[:-1, :] * np.uint8(1 << UP)
+        self.open_mask[:-1, :] |= free[1:, :] * np.uint8(1 << DOWN)
+        self.open_mask[:, 1:] |= free[:, :-1] * np.uint8(1 << LEFT)
+        self.open_mask[:, :-1] |= free[:, 1:] * np.uint8(1 << RIGHT)
         self.position = start
-        self.directions = {
-            "UP": (-1, 0),
-            "DOWN": (1, 0),
-            "LEFT": (0, -1),
-            "RIGHT": (0, 1),
-        }
+        # Memoized move outcomes keyed by (y, x, direction)
+        self.jumps: dict[
+            tuple[int, int, str], tuple[tuple[int, int], tuple[str, ...]]
+        ] = {}
 
     def move(self, direction: str) -> list[str]:
-        dy, dx = self.directions[direction]
-        y, x = self.position
+        # Maze is static, so the outcome of a move only depends on where it starts
+        key = (*self.position, direction)
+        if key not in self.jumps:
+            self.jumps[key] = self.walk(*self.position, direction)
+        self.position, steps = self.jumps[key]
+        return list(steps)
+
+    def walk(self, y, x, direction: str) -> tuple[tuple[int, int], tuple[str, ...]]:
+        """Walk until blocked, at a cross-section or at the end. Return the stop position and steps."""
+        d = NAME_TO_ID[direction]
+        dy, dx = DELTAS[d]
+        bit = 1 << d
         steps: list[str] = []
 
-        while not self.is_blocked(y, x, direction):
-            new_y, new_x = y + dy, x + dx
-            if 0 <= new_y < len(self.maze.grid) and 0 <= new_x < len(self.maze.grid[0]):
-                y, x = new_y, new_x
-                self.position = (y, x)
-                steps.append(f"Moved {direction} to ({y}, {x})")
-            else:
-                steps.append("Stopped: Out of bounds")  # Debug print
-                return steps
+        while self.open_mask[y, x] & bit:
+            y, x = y + dy, x + dx
+            steps.append(f"Moved {direction} to ({y}, {x})")
 
             if self.is_end_nearby(y, x):
                 steps.append("Stopped: At the end")
-                return steps
+                return (y, x), tuple(steps)
 
-            print(f"Moved to ({y}, {x})")
-            if self.is_cross_section(y, x, direction):
+            if DEBUG:
+                print(f"Moved to ({y}, {x})")
+            if self.is_cross_section(y, x, d):
                 steps.append("Stopped: at a cross-section")
-                steps.append(
-                    f"From current location you may move: {self.free_directions().replace(':', ', ')}"
-                )
-                return steps
+                break
+        else:
+            steps.append("Stopped: Path is blocked")
 
-        steps.append("Stopped: Path is blocked")
         steps.append(
-            f"From current location you may move: {self.free_directions().replace(':', ', ')}"
+            f"From current location you may move: {self.free_directions_at(y, x).replace(':', ', ')}"
         )
-        return steps
+        return (y, x), tuple(steps)
 
-    def is_cross_section(self, y, x, direction):
+    def is_cross_section(self, y, x, d: int):
         """Check if the current position is a cross-section or if the end 'E' is reached."""
-        print(f"Checking cross-section at ({y}, {x}) in direction {direction}")
+        if DEBUG:
+            print(f"Checking cross-section at ({y}, {x}) in direction {NAMES[d]}")
 
         # Check for openings directly adjacent in perpendicular directions
         perp_openings = False
-        if direction in ["UP", "DOWN"]:
+        open_mask = self.open_mask[y, x]
+        if d in (UP, DOWN):
             # Check LEFT and RIGHT for perpendicular openings
-            if x > 0 and self.maze.grid[y][x - 1] == 0:
+            if open_mask & (1 << LEFT):
                 perp_openings = True
-                print(f"Open path in perpendicular direction LEFT at ({y}, {x - 1})")
-            if x < len(self.maze.grid[0]) - 1 and self.maze.grid[y][x + 1] == 0:
+                if DEBUG:
+                    print(
+                        f"Open path in perpendicular direction LEFT at ({y}, {x - 1})"
+                    )
+            if open_mask & (1 << RIGHT):
                 perp_openings = True
-                print(f"Open path in perpendicular direction RIGHT at ({y}, {x + 1})")
-        elif direction in ["LEFT", "RIGHT"]:
+                if DEBUG:
+                    print(
+                        f"Open path in perpendicular direction RIGHT at ({y}, {x + 1})"
+                    )
+        else:
             # Check UP and DOWN for perpendicular openings
-            if y > 0 and self.maze.grid[y - 1][x] == 0:
+            if open_mask & (1 << UP):
                 perp_openings = True
-                print(f"Open path in perpendicular direction UP at ({y - 1}, {x})")
-            if y < len(self.maze.grid) - 1 and self.maze.grid[y + 1][x] == 0:
+                if DEBUG:
+                    print(f"Open path in perpendicular direction UP at ({y - 1}, {x})")
+            if open_mask & (1 << DOWN):
                 perp_openings = True
-                print(f"Open path in perpendicular direction DOWN at ({y + 1}, {x})")
+                if DEBUG:
+                    print(
+                        f"Open path in perpendicular direction DOWN at ({y + 1}, {x})"
+                    )
 
         if perp_openings:
-            print("Cross-section found")
+            if DEBUG:
+                print("Cross-section found")
             return True
 
-        print("No cross-section or dead end found")
+        if DEBUG:
+            print("No cross-section or dead end found")
         return False
 
     def is_end_nearby(self, y, x):
@@ -94,39 +139,20 @@ class MazePlayer:
 
     def is_blocked(self, y, x, direction: str) -> bool:
         """Check if movement in the current direction is blocked."""
-        dy, dx = self.directions[direction]
-        next_y, next_x = y + dy, x + dx
-        if not self.is_in_bounds(next_y, next_x):
-            return True
-        return self.maze.grid[next_y][next_x] == 1
+        return not self.open_mask[y, x] & (1 << NAME_TO_ID[direction])
 
     def is_in_bounds(self, y, x):
-        return 0 <= y < len(self.maze.grid) and 0 <= x < len(self.maze.grid[0])
+        return 0 <= y < self.height and 0 <= x < self.width
 
     def is_at_end(self):
         y, x = self.position
         return self.is_end_nearby(y, x)
 
     def free_directions(self) -> str:
-        free_dirs = []
-        y, x = self.position
-
-        for direction, (dy, dx) in self.directions.items():
-            new_y, new_x = y + dy, x + dx
-            if self.is_in_bounds(new_y, new_x) and not self.is_blocked(y, x, direction):
-                free_dirs.append(direction)
-
-        return ":".join(sorted(free_dirs))
+        return self.free_directions_at(*self.position)
 
-    def all_direction_combinations(self) -> list[tuple[str]]:
-        free_dirs = sorted(self.directions.keys())
-        all_combinations = []
-
-        for r in range(1, len(free_dirs) + 1):
-            for combo in combinations(free_dirs, r):
-                all_combinations.append(combo)
-
-        return all_combinations
+    def free_directions_at(self, y, x) -> str:
+        return MASK_TO_STATE[self.open_mask[y, x]]
 
 
 def display_maze(maze, player):
@@ -242,29 +268,24 @@ maze_game_agent_builder = (
     .add_end_state("DONE")
 )
 
-
-def match_directions_to_callables(direction_combination) -> set[Callable]:
-    callables = set()
-    direction_to_function = {
-        "UP": move_up,
-        "DOWN": move_down,
-        "LEFT": move_left,
-        "RIGHT": move_right,
-    }
-
-    for direction in direction_combination:
-        if direction in direction_to_function:
-            callables.add(direction_to_function[direction])
-
-    return callables
-
-
-for state in player.all_direction_combinations():
-    state_str = ":".join(sorted(state))
-    print(state_str)
-    maze_game_agent_builder.add_state_and_transitions(
-        state_str, match_directions_to_callables(state)
-    )
+DIRECTION_TO_FUNCTION: dict[str, Callable[[str], str]] = {
+    "UP": move_up,
+    "DOWN": move_down,
+    "LEFT": move_left,
+    "RIGHT": move_right,
+}
+
+# Every non-empty combination of free directions, each already in sorted order
+ALL_DIRECTION_COMBINATIONS = [
+    combo
+    for r in range(1, len(DIRECTION_TO_FUNCTION) + 1)
+    for combo in combinations(sorted(DIRECTION_TO_FUNCTION), r)
+]
+
+maze_game_agent_builder.add_states_bulk(
+    (":".join(combo), {DIRECTION_TO_FUNCTION[direction] for direction in combo})
+    for combo in ALL_DIRECTION_COMBINATIONS
+)
 
 
 maze_game_agent_builder.add_state_and_transitions("INIT", {start})
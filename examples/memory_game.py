@@ -1,25 +1,33 @@
+import logging
 import random
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Show agent steps, library logs them at DEBUG level
+logging.basicConfig(format="%(message)s")
+logging.getLogger("llmstatemachine").setLevel(logging.DEBUG)
+
 from llmstatemachine import WorkflowAgentBuilder, set_next_state
 
 
 def initialize_game(num_pairs):
     """Create and shuffle the deck, then display it as a hidden board."""
-    init_deck = list(range(1, num_pairs + 1)) * 2
-    random.shuffle(init_deck)
-    return init_deck, [False] * len(init_deck)
+    population = tuple(range(1, num_pairs + 1)) * 2
+    init_deck = random.sample(population, len(population))
+    return init_deck, bytearray(len(init_deck))
 
 
 deck, board = initialize_game(10)
+# Position labels never change, only the card values shown after them
+PREFIXES = [f"{i}:" for i in range(len(deck))]
 
 
 def display_board(argument: str) -> str:
     board_state = " ".join(
-        f'{i}:{deck[i] if board[i] else "X"}' for i in range(len(deck))
+        prefix + (str(deck[i]) if board[i] else "X")
+        for i, prefix in enumerate(PREFIXES)
     )
     return f"display_board: (position:value or X if hidden) {board_state}"
 
@@ -27,13 +35,13 @@ def display_board(argument: str) -> str:
 def flip_card(argument: str) -> str:
     position = int(argument)
     if board[position]:
-        board[position] = False
+        board[position] = 0
         print(f"< debug not shown to agent {display_board('')} >")
         set_next_state("INIT")
         return f"flip_card: Hide card at position {position}."
-    board[position] = True
+    board[position] = 1
     print(f"< debug not shown to agent {display_board('')} >")
-    if all(board):
+    if 0 not in board:
         set_next_state("COMPLETE")
     return f"flip_card: Showing card at position {position}. Value is {deck[position]}."
 
@@ -0,0 +1,14 @@
+# orjson parses and serializes several times faster, use it when installed
+try:
+    import orjson
+
+    loads = orjson.loads
+
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    import json
+
+    loads = json.loads
+    dumps = json.dumps
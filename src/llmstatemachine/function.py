@@ -1,8 +1,38 @@
+import asyncio
+import hashlib
 import inspect
-import json
-from typing import Callable, TypedDict
+import logging
+import os
+import sqlite3
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, List, TypedDict
 
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+from openai.types.chat import ChatCompletion
+
+from ._json import dumps, loads
+
+# Metadata extraction is simple, a small model is enough
+MODEL = os.environ.get("LSM_METADATA_MODEL", "gpt-4o-mini")
+MAX_PARALLEL_DEFINITIONS = 16
+CACHE_PATH = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache")
+    / "llmstatemachine"
+    / "function_defs.sqlite"
+)
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def openai_client() -> OpenAI:
+    # Created on first use, OpenAI() fails without an API key.
+    # Shared so all requests reuse one connection pool.
+    return OpenAI()
 
 
 class FunctionDefinition(TypedDict):
@@ -11,17 +41,96 @@ class FunctionDefinition(TypedDict):
     argument_description: str
 
 
+_REQUIRED_KEYS = ("function_name", "function_description", "argument_description")
+
+
 def is_valid_function_definition(data: dict) -> bool:
-    required_keys = ['function_name', 'function_description', 'argument_description']
-    return all(key in data and isinstance(data[key], str) for key in required_keys)
+    # Parsed JSON holds plain str values, exact type check is enough
+    return isinstance(data, dict) and all(
+        type(data.get(key)) is str for key in _REQUIRED_KEYS
+    )
+
+
+def _connect_cache() -> sqlite3.Connection:
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(CACHE_PATH)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS defs(key TEXT PRIMARY KEY, value TEXT)"
+    )
+    return connection
+
 
+def _read_cached_definition(key: str) -> FunctionDefinition | None:
+    try:
+        with closing(_connect_cache()) as connection:
+            row = connection.execute(
+                "SELECT value FROM defs WHERE key = ?", (key,)
+            ).fetchone()
+    except (OSError, sqlite3.Error):
+        # Cache is best effort, fall back to asking the model
+        return None
+    if row is None:
+        return None
+    try:
+        definition = loads(row[0])
+    except (TypeError, ValueError):
+        definition = None
+    if not is_valid_function_definition(definition):
+        # Corrupt entry, drop it so the fresh definition replaces it
+        _delete_cached_definition(key)
+        return None
+    return definition
 
 
-def create_definition(func: Callable, goal: str) -> FunctionDefinition:
-    source = inspect.getsource(func)
-    client = OpenAI()
-    response = client.chat.completions.create(
-        model="gpt-4-1106-preview",
+def _delete_cached_definition(key: str):
+    try:
+        with closing(_connect_cache()) as connection, connection:
+            connection.execute("DELETE FROM defs WHERE key = ?", (key,))
+    except (OSError, sqlite3.Error):
+        pass
+
+
+def _write_cached_definition(key: str, definition: FunctionDefinition):
+    try:
+        with closing(_connect_cache()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO defs(key, value) VALUES (?, ?)",
+                (key, dumps(definition)),
+            )
+    except (OSError, sqlite3.Error):
+        pass
+
+
+@lru_cache(maxsize=512)
+def _function_source(func: Callable) -> str:
+    # Functions hash by identity, repeated lookups skip reading the source file.
+    # A documented signature describes the function in far fewer tokens than
+    # its body, undocumented functions still need the full source.
+    if func.__doc__:
+        doc = textwrap.indent(f'"""{inspect.cleandoc(func.__doc__)}"""', "    ")
+        return f"def {func.__name__}{inspect.signature(func)}:\n{doc}\n"
+    return inspect.getsource(func)
+
+
+def _definition_cache_key(source: str, goal: str | None) -> str:
+    # Separators keep different source and goal splits from sharing a key
+    key = "\0".join((source, goal or "", MODEL))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _definition_request(source: str, goal: str | None) -> Dict[str, Any]:
+    focus = (
+        f"""
+Focus on details that are meaningful for the following assignment:
+```
+{goal}
+```
+"""
+        if goal
+        else ""
+    )
+    return dict(
+        model=MODEL,
         messages=[
             {
                 "role": "system",
@@ -29,12 +138,7 @@ def create_definition(func: Callable, goal: str) -> FunctionDefinition:
 ```
 {source}
 ```
-
-Focus on details that are meaningful for the following assignment:
-```
-{goal}
-```
-
+{focus}
 Extract the function metadata.
 """,
             }
@@ -76,12 +180,76 @@ Extract the function metadata.
         ],
         function_call={"name": "FunctionDefinition"},
     )
+
+
+def _parse_definition(response: ChatCompletion) -> FunctionDefinition:
     msg = response.choices[0].message
     assert msg.function_call
-    print(msg.function_call)
-    args: FunctionDefinition = json.loads(msg.function_call.arguments)
+    logger.debug("%s", msg.function_call)
+    args: FunctionDefinition = loads(msg.function_call.arguments)
 
     if not is_valid_function_definition(args):
         raise ValueError("Invalid data format for FunctionDefinition")
+    return args
+
+
+def create_definition(func: Callable, goal: str | None = None) -> FunctionDefinition:
+    source = _function_source(func)
+    cache_key = _definition_cache_key(source, goal)
+    cached = _read_cached_definition(cache_key)
+    if cached is not None:
+        return cached
 
+    response = openai_client().chat.completions.create(
+        **_definition_request(source, goal)
+    )
+    args = _parse_definition(response)
+    _write_cached_definition(cache_key, args)
     return args
+
+
+async def create_definition_async(
+    func: Callable, goal: str | None = None, client: AsyncOpenAI | None = None
+) -> FunctionDefinition:
+    if client is None:
+        async with AsyncOpenAI() as client:
+            return await create_definition_async(func, goal, client)
+
+    source = _function_source(func)
+    cache_key = _definition_cache_key(source, goal)
+    # sqlite and the cache directory are blocking file system access
+    cached = await asyncio.to_thread(_read_cached_definition, cache_key)
+    if cached is not None:
+        return cached
+
+    response = await client.chat.completions.create(
+        **_definition_request(source, goal)
+    )
+    args = _parse_definition(response)
+    await asyncio.to_thread(_write_cached_definition, cache_key, args)
+    return args
+
+
+def create_definitions(
+    funcs: List[Callable], goal: str | None = None
+) -> Dict[Callable, FunctionDefinition]:
+    if not funcs:
+        return {}
+    # Requests are independent and network bound, so run them concurrently
+    workers = min(MAX_PARALLEL_DEFINITIONS, len(funcs))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        definitions = executor.map(lambda func: create_definition(func, goal), funcs)
+        return dict(zip(funcs, definitions))
+
+
+async def create_definitions_async(
+    funcs: List[Callable], goal: str | None = None
+) -> Dict[Callable, FunctionDefinition]:
+    if not funcs:
+        return {}
+    # One client, so all requests share its connection pool
+    async with AsyncOpenAI() as client:
+        definitions = await asyncio.gather(
+            *(create_definition_async(func, goal, client) for func in funcs)
+        )
+    return dict(zip(funcs, definitions))
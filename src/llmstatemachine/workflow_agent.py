@@ -1,12 +1,22 @@
-import json
-from typing import Dict, Callable, Any, Tuple, List
+import asyncio
+import logging
+from contextvars import ContextVar
+from types import MappingProxyType
+from typing import Dict, Callable, Any, Tuple, List, Iterable, Iterator, Mapping
 
 from openai.types.chat.chat_completion_message import FunctionCall
 
-from .function import create_definition, FunctionDefinition
+from ._json import loads
+from .function import (
+    create_definitions,
+    create_definitions_async,
+    openai_client,
+    FunctionDefinition,
+)
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 from openai.types.chat import (
+    ChatCompletion,
     ChatCompletionMessageParam,
     ChatCompletionMessage,
     completion_create_params,
@@ -15,29 +25,66 @@ from openai.types.chat import (
 TransitionFunction = Callable[[...], str]
 FUNCTION_NAME = "ActionSelector"
 MODEL = "gpt-4-1106-preview"  # "gpt-4"
-_CURRENT_STEPPING_AGENT = None
+MAX_HISTORY = 20
+PURGED_CONTENT = "<purged>"
+# Per thread and per asyncio task, so concurrent agents do not see each other
+_CURRENT_STEPPING_AGENT: ContextVar["WorkflowAgent | None"] = ContextVar(
+    "current_stepping_agent", default=None
+)
+
+logger = logging.getLogger(__name__)
 
 
 class WorkflowAgent:
     def __init__(
-            self, goal: str, transitions: Dict[str, Dict[str, TransitionFunction]]
+            self,
+            goal: str,
+            transitions: Dict[str, Dict[str, TransitionFunction]],
+            func_defs: Dict[TransitionFunction, FunctionDefinition] | None = None,
+            max_history: int | None = MAX_HISTORY,
     ):
         if "INIT" not in transitions:
             raise Exception("Must define INIT state")
-        self._transitions: Dict[str, Dict[str, TransitionFunction]] = transitions
+        # Read-only copy, later changes to the given dicts do not affect the agent
+        self._transitions: Mapping[str, Mapping[str, TransitionFunction]] = (
+            MappingProxyType(
+                {
+                    state: MappingProxyType(dict(funcs))
+                    for state, funcs in transitions.items()
+                }
+            )
+        )
+        # Case-insensitive fallback for actions the model does not spell exactly
+        self._transitions_lc: Dict[str, Dict[str, TransitionFunction]] = {
+            state: {name.lower(): func for name, func in funcs.items()}
+            for state, funcs in self._transitions.items()
+        }
         self._current_state = "INIT"
         self.next_state = None
         self._messages: List[ChatCompletionMessageParam] = []
         self._messages.append({"role": "system", "content": goal})
-        self._client = OpenAI()
-        self._func_defs: Dict[TransitionFunction, FunctionDefinition] = dict()
-        for name_dict in self._transitions.values():
-            for func in name_dict.values():
-                if func not in self._func_defs:
-                    self._func_defs[func] = create_definition(func, goal)
+        # Function results older than the last max_history messages are purged
+        self._max_history = _check_max_history(max_history)
+        self._purged_until = 1
+        self._client = openai_client()
+        # Async client connections belong to the event loop that opened them
+        self._aclient: AsyncOpenAI | None = None
+        self._aclient_loop: asyncio.AbstractEventLoop | None = None
+        if func_defs is None:
+            func_defs = create_definitions(_unique_functions(transitions), goal)
+        self._func_defs: Dict[TransitionFunction, FunctionDefinition] = func_defs
+        # Same for every step, keeps the prompt prefix cacheable by OpenAI
+        self._messages.append(
+            {"role": "system", "content": self._actions_overview(transitions)}
+        )
+        # One selector for every state, OpenAI caches function definitions as part
+        # of the prompt prefix. trigger rejects actions not allowed in a state.
+        self._action_selector = self._build_selector(transitions)
 
     def trigger(self, function_call: str, args: List[Any]) -> str:
-        transition_func = self._transitions[self._current_state].get(function_call)
+        transition_func = self._transitions[self._current_state].get(
+            function_call
+        ) or self._transitions_lc[self._current_state].get(function_call.lower())
         if transition_func:
             try:
                 result = transition_func(*args)
@@ -55,6 +102,15 @@ class WorkflowAgent:
 
     def add_message(self, message: ChatCompletionMessageParam | ChatCompletionMessage):
         self._messages.append(message)
+        if self._max_history is not None:
+            self._purge_old_results(len(self._messages) - self._max_history)
+
+    def _purge_old_results(self, until: int):
+        while self._purged_until < until:
+            old = self._messages[self._purged_until]
+            if isinstance(old, dict) and old.get("role") == "function":
+                self._messages[self._purged_until] = {**old, "content": PURGED_CONTENT}
+            self._purged_until += 1
 
     @property
     def current_state(self):
@@ -71,18 +127,31 @@ class WorkflowAgent:
         return self._messages[-1]
 
     def function_def_action_selector(self) -> completion_create_params.Function:
-        actions = []
-        action_descriptions = []
-        argument_descriptions = []
-        for func in self._transitions[self._current_state].values():
-            definition = self._func_defs[func]
-            actions.append(definition["function_name"])
-            action_descriptions.append(
-                definition["function_name"] + ": " + definition["function_description"]
-            )
-            argument_descriptions.append(
-                f"For {definition['function_name']} argument: {definition['argument_description']}"
-            )
+        return self._action_selector
+
+    def _actions_overview(
+            self, transitions: Mapping[str, Mapping[str, TransitionFunction]]
+    ) -> str:
+        # Sorted so the message is byte identical across runs
+        definitions = sorted(
+            (self._func_defs[func] for func in _unique_functions(transitions)),
+            key=lambda d: d["function_name"],
+        )
+        return "Actions available for ActionSelector:\n" + "\n".join(
+            f"{d['function_name']}: {d['function_description']}\n"
+            f"For {d['function_name']} argument: {d['argument_description']}"
+            for d in definitions
+        )
+
+    def _build_selector(
+            self, transitions: Mapping[str, Mapping[str, TransitionFunction]]
+    ) -> completion_create_params.Function:
+        actions = sorted(
+            {
+                self._func_defs[func]["function_name"]
+                for func in _unique_functions(transitions)
+            }
+        )
         return {
             "description": "ActionSelector is a tool that selects next action",
             "name": "ActionSelector",
@@ -100,44 +169,79 @@ class WorkflowAgent:
                     "action": {
                         "type": "string",
                         "enum": actions,
-                        "description": "\n".join(action_descriptions),
+                        "description": "Next action, see the actions described in the system message.",
                     },
                     "argument": {
                         "type": "string",
-                        "description": "\n".join(argument_descriptions),
+                        "description": "Argument for the selected action.",
                     },
                 },
                 "required": ["thinking", "action", "argument"],
             },
         }
 
+    def __iter__(self) -> Iterator[str]:
+        # End states have no transitions
+        while self._transitions[self.current_state]:
+            yield self.step()
+
     def run(self, callback: Callable[[str], Any] | None = None) -> str:
+        result = "No result"
+        for result in self:
+            if callback:
+                callback(result)
+        return result
+
+    def step(self) -> str:
+        response = self._client.chat.completions.create(**self._step_request())
+        return self._handle_step_response(response)
+
+    async def astep(self) -> str:
+        loop = asyncio.get_running_loop()
+        if self._aclient is None or self._aclient_loop is not loop:
+            self._aclient = AsyncOpenAI()
+            self._aclient_loop = loop
+        response = await self._aclient.chat.completions.create(**self._step_request())
+        return self._handle_step_response(response)
+
+    async def arun(self, callback: Callable[[str], Any] | None = None) -> str:
         result = "No result"
         while self._transitions[self.current_state]:
-            result = self.step()
+            result = await self.astep()
             if callback:
                 callback(result)
         return result
 
-    def step(self):
-        global _CURRENT_STEPPING_AGENT
-        response = self._client.chat.completions.create(
+    def _step_request(self) -> Dict[str, Any]:
+        return dict(
             model=MODEL,
             messages=self._messages,
             functions=[self.function_def_action_selector()],
             function_call={"name": "ActionSelector"},
         )
-        print("=" * 80)
-        print(
-            f"tokens: {response.usage.total_tokens} total; {response.usage.completion_tokens} completion; {response.usage.prompt_tokens} prompt"
-        )
-        print("=" * 80)
+
+    def _handle_step_response(self, response: ChatCompletion) -> str:
+        if logger.isEnabledFor(logging.DEBUG):
+            details = getattr(response.usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", None) or 0
+            logger.debug("=" * 80)
+            logger.debug(
+                "tokens: %s total; %s completion; %s prompt; %s cached",
+                response.usage.total_tokens,
+                response.usage.completion_tokens,
+                response.usage.prompt_tokens,
+                cached_tokens,
+            )
+            logger.debug("=" * 80)
         msg = response.choices[0].message
         assert msg.function_call
-        _CURRENT_STEPPING_AGENT = self
-        res = self._execute_function_call(msg.function_call)
-        _CURRENT_STEPPING_AGENT = None
-        print(res[:120] + ("..." if len(res) > 120 else ""))
+        token = _CURRENT_STEPPING_AGENT.set(self)
+        try:
+            res = self._execute_function_call(msg.function_call)
+        finally:
+            _CURRENT_STEPPING_AGENT.reset(token)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s%s", res[:120], "..." if len(res) > 120 else "")
         self.add_message(msg)
         self.add_message(
             {"role": "function", "name": msg.function_call.name, "content": res}
@@ -147,30 +251,53 @@ class WorkflowAgent:
     def _execute_function_call(self, function_call: FunctionCall) -> str:
         if function_call.name != FUNCTION_NAME:
             return f"Error: function {function_call.name} does not exist"
-        args = json.loads(function_call.arguments)
+        args = loads(function_call.arguments)
         for key in args:
-            print(f'{key}: {args[key]}')
+            logger.debug("%s: %s", key, args[key])
         action = args["action"]
         argument = args["argument"]
-        return self.trigger(action.lower(), [argument])
+        return self.trigger(action, [argument])
+
+
+def _unique_functions(
+        transitions: Mapping[str, Mapping[str, TransitionFunction]]
+) -> List[TransitionFunction]:
+    return list(
+        dict.fromkeys(
+            func for name_dict in transitions.values() for func in name_dict.values()
+        )
+    )
+
+
+def _check_max_history(max_history: int | None) -> int | None:
+    # Zero would purge a function result before the model has seen it
+    if max_history is not None and max_history < 1:
+        raise ValueError(f"max_history must be at least 1, got {max_history}")
+    return max_history
 
 
 def set_next_state(state: str):
-    if _CURRENT_STEPPING_AGENT:
-        _CURRENT_STEPPING_AGENT.next_state = state
+    agent = _CURRENT_STEPPING_AGENT.get()
+    if agent:
+        agent.next_state = state
 
 
 class WorkflowAgentBuilder:
     def __init__(self):
         self._system_message = ""
+        self._max_history: int | None = MAX_HISTORY
         self._transitions: Dict[str, Dict[str, TransitionFunction]] = dict()
 
     def add_system_message(self, message: str):
         self._system_message = message
         return self
 
+    def set_max_history(self, max_history: int | None):
+        self._max_history = _check_max_history(max_history)
+        return self
+
     def add_state_and_transitions(
-            self, state_name: str, transition_functions: set[TransitionFunction]
+            self, state_name: str, transition_functions: Iterable[TransitionFunction]
     ):
         if state_name in self._transitions:
             raise Exception(f"State {state_name} transition already defined")
@@ -179,6 +306,13 @@ class WorkflowAgentBuilder:
         }
         return self
 
+    def add_states_bulk(
+            self, entries: Iterable[Tuple[str, Iterable[TransitionFunction]]]
+    ):
+        for state_name, transition_functions in entries:
+            self.add_state_and_transitions(state_name, transition_functions)
+        return self
+
     def add_end_state(self, state_name: str):
         if state_name in self._transitions:
             raise Exception(f"State {state_name} already defined")
@@ -188,4 +322,16 @@ class WorkflowAgentBuilder:
     def build(self) -> WorkflowAgent:
         if "INIT" not in self._transitions:
             raise Exception("Must define INIT state")
-        return WorkflowAgent(self._system_message, self._transitions)
+        return WorkflowAgent(
+            self._system_message, self._transitions, max_history=self._max_history
+        )
+
+    async def build_async(self) -> WorkflowAgent:
+        if "INIT" not in self._transitions:
+            raise Exception("Must define INIT state")
+        func_defs = await create_definitions_async(
+            _unique_functions(self._transitions), self._system_message
+        )
+        return WorkflowAgent(
+            self._system_message, self._transitions, func_defs, self._max_history
+        )
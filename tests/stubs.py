@@ -0,0 +1,112 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Callable, List
+
+from openai.types.chat import ChatCompletion
+
+
+def completion_data(name: str, arguments: dict) -> dict:
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "stub",
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "function_call",
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "function_call": {
+                        "name": name,
+                        "arguments": json.dumps(arguments),
+                    },
+                },
+            }
+        ],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def action_data(action: str, argument: str = "") -> dict:
+    return completion_data(
+        "ActionSelector", {"thinking": "", "action": action, "argument": argument}
+    )
+
+
+def definition_for(func: Callable) -> dict:
+    return {
+        "function_name": func.__name__,
+        "function_description": f"Calls {func.__name__}.",
+        "argument_description": "Unused.",
+    }
+
+
+class StubClient:
+    """Stands in for OpenAI, answers requests with the queued completions."""
+
+    def __init__(self, replies: List[dict] | None = None):
+        self.replies = list(replies or [])
+        self.requests: List[dict] = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, **kwargs) -> ChatCompletion:
+        self.requests.append(kwargs)
+        return ChatCompletion.model_validate(self.replies.pop(0))
+
+
+class AsyncStubClient(StubClient):
+    """Stands in for AsyncOpenAI, answers requests with the queued completions."""
+
+    def __init__(self, replies: List[dict] | None = None):
+        super().__init__(replies)
+        self.closed = False
+
+    async def create(self, **kwargs) -> ChatCompletion:
+        return super().create(**kwargs)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.closed = True
+
+
+class CompletionServer(ThreadingHTTPServer):
+    """Keep-alive HTTP server answering every request with the same completion."""
+
+    daemon_threads = True
+
+    def __init__(self, reply: dict):
+        self.reply = json.dumps(reply).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(handler):
+                handler.rfile.read(int(handler.headers["Content-Length"]))
+                handler.send_response(200)
+                handler.send_header("Content-Type", "application/json")
+                handler.send_header("Content-Length", str(len(self.reply)))
+                handler.end_headers()
+                handler.wfile.write(self.reply)
+
+            def log_message(handler, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,116 @@
+import asyncio
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+from llmstatemachine import function
+
+from .stubs import AsyncStubClient, StubClient, completion_data, definition_for
+
+
+def greet(argument: str) -> str:
+    """Greet the given name."""
+    return f"Hello {argument}"
+
+
+def wave(argument: str) -> str:
+    """Wave at the given name."""
+    return f"Bye {argument}"
+
+
+def definition_reply(func) -> dict:
+    return completion_data(
+        "FunctionDefinition", {"thinking": "", **definition_for(func)}
+    )
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path) -> StubClient:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    monkeypatch.setattr(
+        function, "CACHE_PATH", tmp_path / "llmstatemachine" / "defs.sqlite"
+    )
+    stub = StubClient([definition_reply(greet) for _ in range(3)])
+    monkeypatch.setattr(function, "openai_client", lambda: stub)
+    return stub
+
+
+def test_cache_hit_skips_model(client):
+    first = function.create_definition(greet, "goal")
+    second = function.create_definition(greet, "goal")
+    assert first == second
+    assert first["function_name"] == "greet"
+    assert len(client.requests) == 1
+
+
+def test_cache_misses_on_goal_change(client):
+    function.create_definition(greet, "goal")
+    function.create_definition(greet, "other goal")
+    assert len(client.requests) == 2
+
+
+def test_cache_misses_on_model_change(client, monkeypatch):
+    function.create_definition(greet, "goal")
+    monkeypatch.setattr(function, "MODEL", "other-model")
+    function.create_definition(greet, "goal")
+    assert len(client.requests) == 2
+    assert client.requests[1]["model"] == "other-model"
+
+
+def test_unwritable_cache_falls_back_to_model(client, monkeypatch, tmp_path):
+    # A file where the cache directory should be makes every access fail
+    blocker = tmp_path / "blocker"
+    blocker.write_text("")
+    monkeypatch.setattr(function, "CACHE_PATH", blocker / "defs.sqlite")
+    assert function.create_definition(greet, "goal")["function_name"] == "greet"
+    assert function.create_definition(greet, "goal")["function_name"] == "greet"
+    assert len(client.requests) == 2
+
+
+def test_corrupt_row_falls_back_to_model(client):
+    key = function._definition_cache_key(function._function_source(greet), "goal")
+    with closing(function._connect_cache()) as connection, connection:
+        connection.execute(
+            "INSERT INTO defs(key, value) VALUES (?, ?)", (key, "{not json")
+        )
+
+    assert function.create_definition(greet, "goal")["function_name"] == "greet"
+    assert function.create_definition(greet, "goal")["function_name"] == "greet"
+    # Bad row was replaced by the fresh definition
+    assert len(client.requests) == 1
+    with closing(sqlite3.connect(function.CACHE_PATH)) as connection:
+        (value,) = connection.execute(
+            "SELECT value FROM defs WHERE key = ?", (key,)
+        ).fetchone()
+    assert "greet" in value
+
+
+@pytest.fixture
+def async_clients(client, monkeypatch) -> list:
+    clients = []
+
+    def make_client() -> AsyncStubClient:
+        stub = AsyncStubClient([definition_reply(greet), definition_reply(greet)])
+        clients.append(stub)
+        return stub
+
+    monkeypatch.setattr(function, "AsyncOpenAI", make_client)
+    return clients
+
+
+def test_async_definitions_share_one_client(async_clients):
+    definitions = asyncio.run(function.create_definitions_async([greet, wave], "goal"))
+    assert list(definitions) == [greet, wave]
+    assert len(async_clients) == 1
+    assert len(async_clients[0].requests) == 2
+    assert async_clients[0].closed
+
+
+def test_async_definition_uses_the_disk_cache(async_clients):
+    first = asyncio.run(function.create_definition_async(greet, "goal"))
+    second = asyncio.run(function.create_definition_async(greet, "goal"))
+    assert first == second
+    # Each call without a client opens and closes its own
+    assert [len(stub.requests) for stub in async_clients] == [1, 0]
+    assert all(stub.closed for stub in async_clients)
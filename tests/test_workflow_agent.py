@@ -0,0 +1,165 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from llmstatemachine import WorkflowAgent, set_next_state, workflow_agent
+
+from .stubs import (
+    CompletionServer,
+    StubClient,
+    action_data,
+    definition_for,
+)
+
+
+def echo(argument: str) -> str:
+    return f"echo {argument}"
+
+
+def make_agent(transitions, **kwargs) -> WorkflowAgent:
+    func_defs = {
+        func: definition_for(func)
+        for funcs in transitions.values()
+        for func in funcs.values()
+    }
+    return WorkflowAgent("Test goal.", transitions, func_defs, **kwargs)
+
+
+@pytest.fixture
+def client(monkeypatch) -> StubClient:
+    stub = StubClient()
+    monkeypatch.setattr(workflow_agent, "openai_client", lambda: stub)
+    return stub
+
+
+def test_astep_across_event_loops(client, monkeypatch):
+    with CompletionServer(action_data("echo", "hi")) as server:
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        agent = make_agent({"INIT": {"echo": echo}})
+        assert asyncio.run(agent.astep()) == "echo hi"
+        assert asyncio.run(agent.astep()) == "echo hi"
+
+
+def contents(agent: WorkflowAgent) -> list:
+    return [
+        message["content"] if isinstance(message, dict) else message.content
+        for message in agent.messages
+    ]
+
+
+def test_history_purges_old_function_results(client):
+    client.replies = [action_data("echo", str(i)) for i in range(4)]
+    agent = make_agent({"INIT": {"echo": echo}}, max_history=3)
+    for _ in range(4):
+        agent.step()
+
+    results = [
+        message["content"]
+        for message in agent.messages
+        if isinstance(message, dict) and message["role"] == "function"
+    ]
+    # Only the last three messages (echo 2, assistant, echo 3) keep results
+    assert results == [
+        workflow_agent.PURGED_CONTENT,
+        workflow_agent.PURGED_CONTENT,
+        "echo 2",
+        "echo 3",
+    ]
+    goal, overview = agent.messages[:2]
+    assert goal == {"role": "system", "content": "Test goal."}
+    assert overview["role"] == "system"
+    assert "echo: Calls echo." in overview["content"]
+    # Assistant messages carrying the model's reasoning are kept
+    assert sum(1 for m in agent.messages if not isinstance(m, dict)) == 4
+
+
+def test_history_none_keeps_everything(client):
+    client.replies = [action_data("echo", str(i)) for i in range(4)]
+    agent = make_agent({"INIT": {"echo": echo}}, max_history=None)
+    for _ in range(4):
+        agent.step()
+    assert workflow_agent.PURGED_CONTENT not in contents(agent)
+    assert [f"echo {i}" for i in range(4)] == [
+        c for c in contents(agent) if c and c.startswith("echo ")
+    ]
+
+
+@pytest.mark.parametrize("max_history", [0, -1])
+def test_history_rejects_non_positive_limits(client, max_history):
+    with pytest.raises(ValueError):
+        make_agent({"INIT": {"echo": echo}}, max_history=max_history)
+    with pytest.raises(ValueError):
+        workflow_agent.WorkflowAgentBuilder().set_max_history(max_history)
+
+
+def Shout(argument: str) -> str:
+    return argument.upper()
+
+
+@pytest.mark.parametrize(
+    "action, expected",
+    [
+        ("Shout", "HI"),
+        ("shout", "HI"),
+        ("ECHO", "echo hi"),
+        ("whisper", "Illegal function call 'whisper' in current state."),
+    ],
+)
+def test_trigger_resolves_action_names(client, action, expected):
+    agent = make_agent({"INIT": {"Shout": Shout, "echo": echo}})
+    assert agent.trigger(action, ["hi"]) == expected
+
+
+def advance(argument: str) -> str:
+    set_next_state("NEXT")
+    return "advanced"
+
+
+def test_selector_schema_is_the_same_in_every_state(client):
+    client.replies = [action_data("advance"), action_data("echo", "hi")]
+    agent = make_agent({"INIT": {"advance": advance}, "NEXT": {"echo": echo}})
+    agent.step()
+    agent.step()
+    first, second = (request["functions"] for request in client.requests)
+    assert first == second
+    assert first[0]["parameters"]["properties"]["action"]["enum"] == [
+        "advance",
+        "echo",
+    ]
+    # Actions from other states are still rejected
+    assert agent.trigger("advance", [""]).startswith("Illegal function call")
+
+
+# Both agents are inside their transition functions at the same time
+barrier = threading.Barrier(2, timeout=5)
+
+
+def first_step(argument: str) -> str:
+    barrier.wait()
+    set_next_state("FIRST_DONE")
+    barrier.wait()
+    return "first"
+
+
+def second_step(argument: str) -> str:
+    barrier.wait()
+    set_next_state("SECOND_DONE")
+    barrier.wait()
+    return "second"
+
+
+def test_concurrent_agents_keep_their_own_state(client):
+    client.replies = [action_data("go"), action_data("go")]
+    first = make_agent({"INIT": {"go": first_step}, "FIRST_DONE": {}})
+    second = make_agent({"INIT": {"go": second_step}, "SECOND_DONE": {}})
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(WorkflowAgent.step, [first, second]))
+
+    assert results == ["first", "second"]
+    assert first.current_state == "FIRST_DONE"
+    assert second.current_state == "SECOND_DONE"
+    assert first.next_state is None and second.next_state is None